@@ -1,30 +1,74 @@
-from flask import Flask, request, jsonify, session, send_from_directory
+from flask import Flask, request, jsonify, session, send_from_directory, g
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
+from argon2 import PasswordHasher
 from flask_jwt_extended import JWTManager, create_access_token, verify_jwt_in_request, get_jwt_identity
 from flask_cors import CORS
 from flask_mail import Mail, Message
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import HTTPException
+from sqlalchemy.exc import SQLAlchemyError
+from eventlet import patcher, tpool
 from datetime import datetime, timedelta
 import os
 import uuid
-import json
+import orjson
+import redis
 from config import Config
 from ml_algorithms import RecommendationEngine, ContentModerator, ImageProcessor
 import logging
 
+class ORJSONProvider(DefaultJSONProvider):
+    """JSON provider that serializes responses with orjson"""
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 # Initialize Flask app
 app = Flask(__name__)
 app.config.from_object(Config)
+app.json = ORJSONProvider(app)
 
 # Initialize extensions
 db = SQLAlchemy(app)
 bcrypt = Bcrypt(app)
+password_hasher = PasswordHasher(
+    time_cost=app.config['ARGON2_TIME_COST'],
+    memory_cost=app.config['ARGON2_MEMORY_COST'],
+    parallelism=app.config['ARGON2_PARALLELISM']
+)
 jwt = JWTManager(app)
 mail = Mail(app)
-socketio = SocketIO(app, cors_allowed_origins="*")
+# eventlet is installed for the gunicorn worker, which monkey-patches before loading the app;
+# everywhere else (python run.py, Celery, flask CLI) use real threads so blocking calls don't
+# serialize requests on an unpatched eventlet hub
+socketio = SocketIO(
+    app, cors_allowed_origins="*",
+    async_mode='eventlet' if patcher.is_monkey_patched('socket') else 'threading'
+)
 cors = CORS(app)
+redis_client = redis.from_url(Config.REDIS_URL)
+
+def run_blocking(func, *args, **kwargs):
+    """Call CPU-bound func in a native thread when serving from the eventlet worker.
+
+    A green thread never yields inside C code, so one password hash or ranking
+    pass would otherwise stall every connection on the worker. Elsewhere (dev
+    server, Celery, flask CLI) func is simply called.
+    """
+    if patcher.is_monkey_patched('thread'):
+        return tpool.execute(func, *args, **kwargs)
+    return func(*args, **kwargs)
 
 # Initialize ML components
 recommendation_engine = RecommendationEngine()
@@ -32,7 +76,7 @@ content_moderator = ContentModerator()
 image_processor = ImageProcessor()
 
 # Import models and routes after app initialization
-from models import User, Post, Story, Like, Comment, Follow, Message, Notification
+from models import User, Post, Story, Like, Comment, Follow, Message, Notification, upgrade_schema, refresh_post_engagement_view
 from routes.auth import auth_bp
 from routes.posts import posts_bp
 from routes.users import users_bp
@@ -50,6 +94,29 @@ app.register_blueprint(recommendations_bp, url_prefix='/api/recommendations')
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def get_current_user():
+    """The authenticated user, loaded on first use and cached in flask.g for the rest of the request.
+
+    Reads the identity the route's verify_jwt_in_request() already checked, so routes
+    that only need get_jwt_identity() never pay for the lookup.
+    """
+    if 'current_user' not in g:
+        user_id = get_jwt_identity()
+        g.current_user = db.session.get(User, user_id) if user_id is not None else None
+    return g.current_user
+
+def revoked_token_key(jti):
+    return f'auth:revoked:{jti}'
+
+# Reject access tokens that were revoked on logout
+@jwt.token_in_blocklist_loader
+def check_if_token_revoked(jwt_header, jwt_payload):
+    try:
+        return redis_client.exists(revoked_token_key(jwt_payload['jti'])) > 0
+    except redis.RedisError as e:
+        logger.warning(f'Token revocation check unavailable: {str(e)}')
+        return False
+
 # Socket.IO events for real-time features
 @socketio.on('connect')
 def on_connect():
@@ -89,11 +156,19 @@ def handle_message(data):
 def health_check():
     return jsonify({'status': 'healthy', 'timestamp': datetime.utcnow().isoformat()})
 
-# Create database tables
-@app.before_first_request
-def create_tables():
+# Create missing tables and upgrade existing ones; run by `flask init-db` and run.py
+def init_database():
     db.create_all()
-    logger.info('Database tables created successfully')
+    with db.engine.begin() as connection:
+        upgrade_schema(connection)
+        # Like counts shouldn't wait for the first refresh_post_engagement beat, which may not be running
+        refresh_post_engagement_view(connection)
+    logger.info('Database schema is up to date')
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create missing tables and upgrade existing ones"""
+    init_database()
 
 # Error handlers
 @app.errorhandler(404)
@@ -105,6 +180,20 @@ def internal_error(error):
     db.session.rollback()
     return jsonify({'error': 'Internal server error'}), 500
 
+@app.errorhandler(HTTPException)
+def http_error(error):
+    # Start from werkzeug's response so headers like Allow (405) or Retry-After (429) survive
+    response = error.get_response()
+    response.data = app.json.dumps({'error': error.description})
+    response.content_type = 'application/json'
+    return response
+
+@app.errorhandler(SQLAlchemyError)
+def database_error(error):
+    db.session.rollback()
+    logger.exception(f'Database error on {request.method} {request.path}')
+    return jsonify({'error': 'Internal server error'}), 500
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', Config.PORT))
     socketio.run(app, host=Config.HOST, port=port, debug=Config.DEBUG)
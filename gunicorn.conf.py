@@ -0,0 +1,13 @@
+# Gunicorn settings for production; gunicorn reads this file from the working directory.
+# SocketIO needs an async worker; one eventlet worker multiplexes many connections, and
+# Flask-SocketIO does not support several gunicorn workers in one process group (no sticky sessions)
+bind = '0.0.0.0:5000'
+worker_class = 'eventlet'
+workers = 1
+worker_connections = 1000
+
+def post_fork(server, worker):
+    # gunicorn monkey-patches the standard library for eventlet, but psycopg2 is a C extension
+    # and would block the whole worker on every query; make it yield to the hub instead
+    from psycogreen.eventlet import patch_psycopg
+    patch_psycopg()
@@ -1,20 +1,53 @@
 import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.feature_extraction.text import HashingVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
 from sklearn.decomposition import TruncatedSVD
-from sklearn.cluster import KMeans
 import pandas as pd
-import pickle
 import os
 from datetime import datetime, timedelta
 import logging
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, NamedTuple
+from scipy.sparse import csr_matrix
+from collections import OrderedDict
 import re
 import hashlib
-from textblob import TextBlob
+import itertools
 
 logger = logging.getLogger(__name__)
 
+INAPPROPRIATE_KEYWORDS = [
+    'spam', 'hate', 'abuse', 'violence', 'harassment', 'bullying',
+    'discrimination', 'threat', 'dangerous', 'illegal'
+]
+INAPPROPRIATE_KEYWORDS_RE = re.compile('|'.join(map(re.escape, INAPPROPRIATE_KEYWORDS)))
+
+SPAM_PATTERNS = [
+    re.compile(r'(buy|sale|discount|offer|deal).*(now|today|urgent)'),
+    re.compile(r'(click|visit).*(link|website|url)'),
+    re.compile(r'(free|win|prize|lottery|money)'),
+    re.compile(r'(urgent|limited|expires|hurry)'),
+]
+
+WORD_RE = re.compile(r'\w+')
+
+class Interactions(NamedTuple):
+    """User-post interactions as parallel arrays (rating: like = 1, comment = 2, share = 3)"""
+    user_ids: np.ndarray
+    post_ids: np.ndarray
+    ratings: np.ndarray
+
+    @classmethod
+    def from_rows(cls, *sources):
+        """Build from (rows, rating) sources, where rows yields (user_id, post_id) pairs"""
+        user_ids, post_ids, ratings = [], [], []
+        for rows, rating in sources:
+            pairs = np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int32).reshape(-1, 2)
+            user_ids.append(pairs[:, 0])
+            post_ids.append(pairs[:, 1])
+            ratings.append(np.full(len(pairs), rating, dtype=np.float32))
+
+        return cls(np.concatenate(user_ids), np.concatenate(post_ids), np.concatenate(ratings))
+
 class RecommendationEngine:
     """Machine Learning based recommendation system for Instagram clone"""
 
@@ -22,36 +55,37 @@ class RecommendationEngine:
         self.user_item_matrix = None
         self.content_features = None
         self.svd_model = None
-        self.content_vectorizer = TfidfVectorizer(max_features=1000, stop_words='english')
+        # Stateless hashing vectorizer: no per-request vocabulary fit, and rows are already L2-normalized
+        self.content_vectorizer = HashingVectorizer(n_features=2 ** 18, stop_words='english',
+                                                    alternate_sign=False, norm='l2')
 
-    def collaborative_filtering_recommendations(self, user_id: int, posts_data: List[Dict], 
-                                               interactions_data: List[Dict], num_recommendations: int = 10) -> List[int]:
+    def collaborative_filtering_recommendations(self, user_id: int, posts_data: List[Dict],
+                                               interactions: Interactions, num_recommendations: int = 10) -> List[int]:
         """Generate recommendations using collaborative filtering"""
         try:
-            # Create user-item interaction matrix
-            user_posts = {}
-            for interaction in interactions_data:
-                user = interaction.get('user_id')
-                post = interaction.get('post_id')
-                rating = interaction.get('rating', 1)  # Like = 1, Comment = 2, Share = 3
-
-                if user not in user_posts:
-                    user_posts[user] = {}
-                user_posts[user][post] = rating
-
-            # Convert to matrix format
-            all_users = list(user_posts.keys())
-            all_posts = list(set([post['id'] for post in posts_data]))
-
-            # Create matrix
-            matrix = np.zeros((len(all_users), len(all_posts)))
-            user_idx = {user: idx for idx, user in enumerate(all_users)}
-            post_idx = {post: idx for idx, post in enumerate(all_posts)}
-
-            for user, posts in user_posts.items():
-                for post, rating in posts.items():
-                    if post in post_idx:
-                        matrix[user_idx[user]][post_idx[post]] = rating
+            # Users with any interaction are the rows, known posts the columns
+            all_users, user_rows = np.unique(interactions.user_ids, return_inverse=True)
+            all_posts = np.unique(np.fromiter((post['id'] for post in posts_data), dtype=np.int64, count=len(posts_data)))
+            if len(all_users) == 0 or len(all_posts) == 0:
+                return self.get_trending_posts(posts_data, num_recommendations)
+
+            post_cols = np.minimum(np.searchsorted(all_posts, interactions.post_ids), len(all_posts) - 1)
+            known = all_posts[post_cols] == interactions.post_ids
+            rows, cols, ratings = user_rows[known], post_cols[known], interactions.ratings[known]
+
+            # Keep each user's strongest interaction per post (a comment outranks a like)
+            keys = rows.astype(np.int64) * len(all_posts) + cols
+            order = np.lexsort((ratings, keys))
+            keys, ratings = keys[order], ratings[order]
+            strongest = np.ones(len(keys), dtype=bool)
+            strongest[:-1] = keys[1:] != keys[:-1]
+            keys = keys[strongest]
+
+            # Create the sparse user-item interaction matrix in one call
+            matrix = csr_matrix(
+                (ratings[strongest], (keys // len(all_posts), keys % len(all_posts))),
+                shape=(len(all_users), len(all_posts)), dtype=np.float32
+            )
 
             # Apply SVD for dimensionality reduction
             if self.svd_model is None:
@@ -59,8 +93,9 @@ class RecommendationEngine:
                 self.svd_model.fit(matrix)
 
             # Generate recommendations for the user
-            if user_id in user_idx:
-                user_vector = matrix[user_idx[user_id]].reshape(1, -1)
+            user_row = np.searchsorted(all_users, user_id)
+            if user_row < len(all_users) and all_users[user_row] == user_id:
+                user_vector = matrix[user_row]
                 user_reduced = self.svd_model.transform(user_vector)
 
                 # Calculate similarity with all posts
@@ -69,7 +104,7 @@ class RecommendationEngine:
 
                 # Get top recommendations
                 recommended_indices = np.argsort(similarities)[::-1][:num_recommendations]
-                recommended_posts = [all_posts[idx] for idx in recommended_indices]
+                recommended_posts = all_posts[recommended_indices].tolist()
 
                 return recommended_posts
 
@@ -96,7 +131,7 @@ class RecommendationEngine:
 
             # Vectorize post content
             if len(post_features) > 0:
-                content_matrix = self.content_vectorizer.fit_transform(post_features)
+                content_matrix = self.content_vectorizer.transform(post_features)
 
                 # Create user profile based on preferences
                 user_content = f"{user_preferences.get('bio', '')} {' '.join(user_preferences.get('interests', []))}"
@@ -118,13 +153,13 @@ class RecommendationEngine:
             return self.get_trending_posts(posts_data, num_recommendations)
 
     def hybrid_recommendations(self, user_id: int, posts_data: List[Dict], 
-                             interactions_data: List[Dict], user_preferences: Dict,
+                             interactions: Interactions, user_preferences: Dict,
                              num_recommendations: int = 10) -> List[int]:
         """Generate hybrid recommendations combining collaborative and content-based filtering"""
         try:
             # Get recommendations from both methods
             collab_recs = self.collaborative_filtering_recommendations(
-                user_id, posts_data, interactions_data, num_recommendations
+                user_id, posts_data, interactions, num_recommendations
             )
             content_recs = self.content_based_recommendations(
                 user_id, posts_data, user_preferences, num_recommendations
@@ -135,18 +170,20 @@ class RecommendationEngine:
             collab_weight = 0.6
             content_weight = 0.4
 
-            # Score posts based on both methods
-            post_scores = {}
+            # Score posts based on both methods: each list contributes its weight scaled by rank
+            ranked_ids = np.array(list(collab_recs) + list(content_recs), dtype=np.int64)
+            rank_weights = np.concatenate([
+                collab_weight * (1 - np.arange(len(collab_recs)) / max(len(collab_recs), 1)),
+                content_weight * (1 - np.arange(len(content_recs)) / max(len(content_recs), 1))
+            ])
 
-            for idx, post_id in enumerate(collab_recs):
-                post_scores[post_id] = post_scores.get(post_id, 0) + collab_weight * (1 - idx / len(collab_recs))
+            post_ids, first_seen, score_idx = np.unique(ranked_ids, return_index=True, return_inverse=True)
+            post_scores = np.zeros(len(post_ids))
+            np.add.at(post_scores, score_idx, rank_weights)
 
-            for idx, post_id in enumerate(content_recs):
-                post_scores[post_id] = post_scores.get(post_id, 0) + content_weight * (1 - idx / len(content_recs))
-
-            # Sort by combined score
-            sorted_posts = sorted(post_scores.items(), key=lambda x: x[1], reverse=True)
-            recommended_posts = [post_id for post_id, score in sorted_posts[:num_recommendations]]
+            # Sort by combined score, breaking ties by first appearance
+            sorted_indices = np.lexsort((first_seen, -post_scores))
+            recommended_posts = post_ids[sorted_indices[:num_recommendations]].tolist()
 
             return recommended_posts
 
@@ -157,57 +194,75 @@ class RecommendationEngine:
     def get_trending_posts(self, posts_data: List[Dict], num_recommendations: int = 10) -> List[int]:
         """Get trending posts based on engagement metrics"""
         try:
-            # Calculate engagement score for each post
-            for post in posts_data:
-                likes = post.get('likes_count', 0)
-                comments = post.get('comments_count', 0)
-                shares = post.get('shares_count', 0)
-
-                # Time decay factor (newer posts get higher score)
-                post_date = datetime.fromisoformat(post.get('created_at', datetime.utcnow().isoformat()))
-                days_old = (datetime.utcnow() - post_date).days
-                time_factor = max(0.1, 1 / (1 + days_old * 0.1))
-
-                # Engagement score formula
-                engagement_score = (likes + comments * 2 + shares * 3) * time_factor
-                post['engagement_score'] = engagement_score
-
-            # Sort by engagement score
-            trending_posts = sorted(posts_data, key=lambda x: x.get('engagement_score', 0), reverse=True)
-
-            return [post['id'] for post in trending_posts[:num_recommendations]]
+            # Parse dates in one vectorized pass and lay the counters out as arrays
+            now = pd.Timestamp(datetime.utcnow())
+            post_dates = pd.to_datetime(
+                [post.get('created_at', now.isoformat()) for post in posts_data], format='ISO8601'
+            )
+            num_posts = len(posts_data)
+
+            return self.rank_trending(
+                post_ids=np.fromiter((post['id'] for post in posts_data), dtype=np.int64, count=num_posts),
+                likes=np.fromiter((post.get('likes_count', 0) for post in posts_data), dtype=np.int64, count=num_posts),
+                comments=np.fromiter((post.get('comments_count', 0) for post in posts_data), dtype=np.int64, count=num_posts),
+                created_at=post_dates.to_numpy(),
+                shares=np.fromiter((post.get('shares_count', 0) for post in posts_data), dtype=np.int64, count=num_posts),
+                num_recommendations=num_recommendations
+            )
 
         except Exception as e:
             logger.error(f"Error in trending posts: {str(e)}")
             return [post['id'] for post in posts_data[:num_recommendations]]
 
-    def user_clustering(self, users_data: List[Dict], interactions_data: List[Dict]) -> Dict[int, int]:
+    def rank_trending(self, post_ids: np.ndarray, likes: np.ndarray, comments: np.ndarray,
+                      created_at: np.ndarray, shares: np.ndarray = None,
+                      num_recommendations: int = 10) -> List[int]:
+        """Rank posts by time-decayed engagement from parallel arrays"""
+        # Time decay factor (newer posts get higher score)
+        days_old = (np.datetime64(datetime.utcnow(), 'us') - created_at) // np.timedelta64(1, 'D')
+        time_factors = np.maximum(0.1, 1 / (1 + days_old * 0.1))
+
+        # Engagement score formula
+        engagement = likes + comments * 2
+        if shares is not None:
+            engagement = engagement + shares * 3
+        engagement_scores = engagement * time_factors
+
+        # Find the Nth best score with a partition instead of a full sort, then order only the
+        # posts at or above it (ties keep input order)
+        top_n = min(num_recommendations, len(engagement_scores))
+        if top_n <= 0:
+            return []
+        threshold = np.partition(-engagement_scores, top_n - 1)[top_n - 1]
+        top_indices = np.flatnonzero(-engagement_scores <= threshold)
+        top_indices = top_indices[np.lexsort((top_indices, -engagement_scores[top_indices]))][:top_n]
+
+        return post_ids[top_indices].tolist()
+
+    def user_clustering(self, users_data: List[Dict], interactions: Interactions) -> Dict[int, int]:
         """Cluster users based on their interaction patterns"""
         try:
             # Create user feature vectors
-            user_features = []
-            user_ids = []
-
-            for user in users_data:
-                # Extract features from user profile and interactions
-                features = [
-                    len(user.get('bio', '')),
-                    user.get('followers_count', 0),
-                    user.get('following_count', 0),
-                    user.get('posts_count', 0),
-                    len([i for i in interactions_data if i.get('user_id') == user.get('id')])
-                ]
-                user_features.append(features)
-                user_ids.append(user['id'])
+            users_df = pd.DataFrame(users_data, columns=['id', 'bio', 'followers_count', 'following_count', 'posts_count'])
+            users_df['bio_length'] = users_df['bio'].fillna('').str.len()
+
+            # Count interactions per user in one grouped pass
+            interacting_users, counts = np.unique(interactions.user_ids, return_counts=True)
+            interaction_counts = pd.Series(counts, index=interacting_users)
+            users_df['interactions_count'] = users_df['id'].map(interaction_counts)
+
+            feature_columns = ['bio_length', 'followers_count', 'following_count', 'posts_count', 'interactions_count']
+            user_features = users_df[feature_columns].fillna(0).to_numpy(dtype=float)
+            user_ids = users_df['id'].tolist()
 
             # Normalize features
-            user_features = np.array(user_features)
             if user_features.shape[0] > 0:
                 user_features = (user_features - np.mean(user_features, axis=0)) / (np.std(user_features, axis=0) + 1e-8)
 
-                # Perform clustering
+                # Perform clustering; sklearn.cluster is only needed by the periodic clustering task
+                from sklearn.cluster import MiniBatchKMeans
                 n_clusters = min(5, len(user_ids))  # Max 5 clusters
-                kmeans = KMeans(n_clusters=n_clusters, random_state=42)
+                kmeans = MiniBatchKMeans(n_clusters=n_clusters, batch_size=1024, n_init=3, random_state=42)
                 cluster_labels = kmeans.fit_predict(user_features)
 
                 # Return user-cluster mapping
@@ -223,14 +278,33 @@ class ContentModerator:
     """AI-powered content moderation system"""
 
     def __init__(self):
-        self.inappropriate_keywords = [
-            'spam', 'hate', 'abuse', 'violence', 'harassment', 'bullying',
-            'discrimination', 'threat', 'dangerous', 'illegal'
-        ]
+        self.inappropriate_keywords = INAPPROPRIATE_KEYWORDS
         self.sentiment_threshold = -0.5
+        # Results keyed by content hash; duplicated spam skips TextBlob entirely
+        self._cache = OrderedDict()
+        self._cache_size = 10000
+
+    def has_inappropriate_keywords(self, text: str) -> bool:
+        """Cheap wordlist check suitable for the request path"""
+        return INAPPROPRIATE_KEYWORDS_RE.search(text.lower()) is not None
 
     def moderate_text(self, text: str) -> Dict[str, any]:
         """Moderate text content for inappropriate material"""
+        key = hashlib.blake2b(text.encode(), digest_size=16).digest() if text else None
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            result = self._cache[key]
+        else:
+            result = self._moderate_text(text)
+            # Don't cache failures so a transient error isn't pinned to the content
+            if key is not None and 'moderation_error' not in result['issues']:
+                self._cache[key] = result
+                if len(self._cache) > self._cache_size:
+                    self._cache.popitem(last=False)
+
+        return {**result, 'issues': list(result['issues'])}
+
+    def _moderate_text(self, text: str) -> Dict[str, any]:
         try:
             moderation_result = {
                 'is_appropriate': True,
@@ -245,14 +319,15 @@ class ContentModerator:
             text_lower = text.lower()
 
             # Check for inappropriate keywords
-            found_keywords = [keyword for keyword in self.inappropriate_keywords if keyword in text_lower]
-            if found_keywords:
+            if INAPPROPRIATE_KEYWORDS_RE.search(text_lower):
                 moderation_result['is_appropriate'] = False
                 moderation_result['issues'].append('inappropriate_language')
                 moderation_result['confidence'] = 0.8
 
             # Sentiment analysis
             try:
+                # Imported here: textblob pulls in nltk, and only the moderation worker gets this far
+                from textblob import TextBlob
                 blob = TextBlob(text)
                 sentiment_score = blob.sentiment.polarity
 
@@ -288,16 +363,9 @@ class ContentModerator:
 
     def _is_spam(self, text: str) -> bool:
         """Simple spam detection based on patterns"""
-        spam_patterns = [
-            r'(buy|sale|discount|offer|deal).*(now|today|urgent)',
-            r'(click|visit).*(link|website|url)',
-            r'(free|win|prize|lottery|money)',
-            r'(urgent|limited|expires|hurry)',
-        ]
-
         text_lower = text.lower()
-        for pattern in spam_patterns:
-            if re.search(pattern, text_lower):
+        for pattern in SPAM_PATTERNS:
+            if pattern.search(text_lower):
                 return True
 
         # Check for excessive repetition
@@ -417,7 +485,7 @@ class ImageProcessor:
             # Analyze caption for keywords
             if caption:
                 # Extract words that could be hashtags
-                words = re.findall(r'\w+', caption.lower())
+                words = WORD_RE.findall(caption.lower())
                 relevant_words = [word for word in words if len(word) > 3 and word.isalpha()]
                 suggested_hashtags.extend([f"#{word}" for word in relevant_words[:3]])
 
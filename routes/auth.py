@@ -1,128 +1,166 @@
-from flask import Blueprint, request, jsonify
-from flask_jwt_extended import create_access_token, verify_jwt_in_request, get_jwt_identity
-from werkzeug.exceptions import BadRequest
-from app import db, bcrypt
+from flask import Blueprint, request, jsonify, current_app
+from flask_jwt_extended import create_access_token, verify_jwt_in_request, get_jwt_identity, get_jwt
+from app import db, bcrypt, redis_client, revoked_token_key
+from sqlalchemy.exc import SQLAlchemyError
 from models import User
+from routes.helpers import get_json_body
 import re
+import string
+import time
+import logging
 from datetime import datetime
+from functools import partial
 
 auth_bp = Blueprint('auth', __name__)
+logger = logging.getLogger(__name__)
+
+_USERNAME_RE = re.compile(r'^[a-zA-Z0-9._]{3,30}$')
+
+# Translation tables that delete every allowed character; anything left over is invalid
+_ALPHA = string.ascii_letters
+_EMAIL_LOCAL_DELETE = str.maketrans('', '', _ALPHA + string.digits + '._%+-')
+_EMAIL_DOMAIN_DELETE = str.maketrans('', '', _ALPHA + string.digits + '.-')
+_EMAIL_TLD_DELETE = str.maketrans('', '', _ALPHA)
 
 def validate_email(email):
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return re.match(pattern, email) is not None
+    # Linear scan equivalent to ^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$ without backtracking
+    local, at, domain = email.partition('@')
+    if not local or not at or local.translate(_EMAIL_LOCAL_DELETE):
+        return False
+
+    host, dot, tld = domain.rpartition('.')
+    return (bool(host) and bool(dot) and len(tld) >= 2
+            and not host.translate(_EMAIL_DOMAIN_DELETE)
+            and not tld.translate(_EMAIL_TLD_DELETE))
 
 def validate_username(username):
-    pattern = r'^[a-zA-Z0-9._]{3,30}$'
-    return re.match(pattern, username) is not None
+    return _USERNAME_RE.match(username) is not None
+
+def record_last_login(app, user_id, logged_in_at):
+    with app.app_context():
+        try:
+            db.session.execute(
+                db.update(User).where(User.id == user_id).values(last_login=logged_in_at)
+            )
+            db.session.commit()
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            logger.warning(f'Failed to record last login for user {user_id}: {str(e)}')
 
 @auth_bp.route('/register', methods=['POST'])
 def register():
-    try:
-        data = request.get_json()
-
-        # Validate required fields
-        required_fields = ['username', 'email', 'full_name', 'password']
-        for field in required_fields:
-            if not data.get(field):
-                return jsonify({'error': f'{field} is required'}), 400
-
-        username = data['username'].lower()
-        email = data['email'].lower()
-        full_name = data['full_name']
-        password = data['password']
-
-        # Validate email format
-        if not validate_email(email):
-            return jsonify({'error': 'Invalid email format'}), 400
-
-        # Validate username format
-        if not validate_username(username):
-            return jsonify({'error': 'Invalid username format. Use 3-30 characters, letters, numbers, dots, and underscores only'}), 400
-
-        # Validate password strength
-        if len(password) < 8:
-            return jsonify({'error': 'Password must be at least 8 characters long'}), 400
-
-        # Check if user already exists
-        existing_user = User.query.filter(
-            (User.username == username) | (User.email == email)
-        ).first()
-
-        if existing_user:
-            if existing_user.username == username:
-                return jsonify({'error': 'Username already exists'}), 409
-            else:
-                return jsonify({'error': 'Email already registered'}), 409
-
-        # Create new user
-        new_user = User(
-            username=username,
-            email=email,
-            full_name=full_name,
-            bio=data.get('bio', ''),
-            phone_number=data.get('phone_number'),
-            website=data.get('website')
-        )
-        new_user.set_password(password)
-
-        db.session.add(new_user)
-        db.session.commit()
-
-        # Create access token
-        access_token = create_access_token(identity=new_user.id)
-
-        return jsonify({
-            'message': 'User registered successfully',
-            'access_token': access_token,
-            'user': new_user.to_dict()
-        }), 201
-
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'error': 'Registration failed', 'details': str(e)}), 500
+    # Validate required fields
+    required_fields = ['username', 'email', 'full_name', 'password']
+    data, missing = get_json_body(required_fields)
+    if missing:
+        return jsonify({'error': f'{missing} is required'}), 400
+    if data is None:
+        return jsonify({'error': 'Invalid JSON body'}), 400
+
+    for field in required_fields:
+        if not data.get(field):
+            return jsonify({'error': f'{field} is required'}), 400
+
+    username = data['username'].lower()
+    email = data['email'].lower()
+    full_name = data['full_name']
+    password = data['password']
+
+    # Validate email format
+    if not validate_email(email):
+        return jsonify({'error': 'Invalid email format'}), 400
+
+    # Validate username format
+    if not validate_username(username):
+        return jsonify({'error': 'Invalid username format. Use 3-30 characters, letters, numbers, dots, and underscores only'}), 400
+
+    # Validate password strength
+    if len(password) < 8:
+        return jsonify({'error': 'Password must be at least 8 characters long'}), 400
+
+    # Check if user already exists
+    existing_user = User.query.filter(
+        (User.username == username) | (User.email == email)
+    ).first()
+
+    if existing_user:
+        if existing_user.username == username:
+            return jsonify({'error': 'Username already exists'}), 409
+        else:
+            return jsonify({'error': 'Email already registered'}), 409
+
+    # Create new user
+    new_user = User(
+        username=username,
+        email=email,
+        full_name=full_name,
+        bio=data.get('bio', ''),
+        phone_number=data.get('phone_number'),
+        website=data.get('website')
+    )
+    new_user.set_password(password)
+
+    db.session.add(new_user)
+    db.session.commit()
+
+    # Create access token
+    access_token = create_access_token(identity=new_user.id)
+
+    return jsonify({
+        'message': 'User registered successfully',
+        'access_token': access_token,
+        'user': new_user.to_dict()
+    }), 201
 
 @auth_bp.route('/login', methods=['POST'])
 def login():
-    try:
-        data = request.get_json()
+    # Validate required fields
+    data, missing = get_json_body(('username', 'password'))
+    if missing:
+        return jsonify({'error': 'Username and password are required'}), 400
+    if data is None:
+        return jsonify({'error': 'Invalid JSON body'}), 400
 
-        # Validate required fields
-        if not data.get('username') or not data.get('password'):
-            return jsonify({'error': 'Username and password are required'}), 400
+    if not data.get('username') or not data.get('password'):
+        return jsonify({'error': 'Username and password are required'}), 400
 
-        username_or_email = data['username'].lower()
-        password = data['password']
+    username_or_email = data['username'].lower()
+    password = data['password']
 
-        # Find user by username or email
-        user = User.query.filter(
-            (User.username == username_or_email) | (User.email == username_or_email)
-        ).first()
+    # Find user by username or email
+    user = User.query.filter(
+        (User.username == username_or_email) | (User.email == username_or_email)
+    ).first()
 
-        if not user:
-            return jsonify({'error': 'Invalid credentials'}), 401
+    if not user:
+        return jsonify({'error': 'Invalid credentials'}), 401
 
-        if not user.is_active:
-            return jsonify({'error': 'Account is deactivated'}), 401
+    if not user.is_active:
+        return jsonify({'error': 'Account is deactivated'}), 401
 
-        if not user.check_password(password):
-            return jsonify({'error': 'Invalid credentials'}), 401
+    if not user.check_password(password):
+        return jsonify({'error': 'Invalid credentials'}), 401
 
-        # Update last login
-        user.last_login = datetime.utcnow()
+    # Upgrade the stored hash while the plaintext is at hand
+    if user.password_needs_rehash():
+        user.set_password(password)
         db.session.commit()
 
-        # Create access token
-        access_token = create_access_token(identity=user.id)
+    # Create access token
+    access_token = create_access_token(identity=user.id)
 
-        return jsonify({
-            'message': 'Login successful',
-            'access_token': access_token,
-            'user': user.to_dict(include_email=True)
-        }), 200
+    response = jsonify({
+        'message': 'Login successful',
+        'access_token': access_token,
+        'user': user.to_dict(include_email=True)
+    })
 
-    except Exception as e:
-        return jsonify({'error': 'Login failed', 'details': str(e)}), 500
+    # last_login is advisory, so write it after the response has been sent
+    response.call_on_close(
+        partial(record_last_login, current_app._get_current_object(), user.id, datetime.utcnow())
+    )
+
+    return response, 200
 
 @auth_bp.route('/verify-token', methods=['GET'])
 def verify_token():
@@ -144,31 +182,28 @@ def verify_token():
 
 @auth_bp.route('/forgot-password', methods=['POST'])
 def forgot_password():
-    try:
-        data = request.get_json()
-        email = data.get('email', '').lower()
-
-        if not email or not validate_email(email):
-            return jsonify({'error': 'Valid email is required'}), 400
+    data = request.get_json()
+    email = data.get('email', '').lower()
 
-        user = User.query.filter_by(email=email).first()
+    if not email or not validate_email(email):
+        return jsonify({'error': 'Valid email is required'}), 400
 
-        # Always return success to prevent email enumeration
-        return jsonify({
-            'message': 'If an account with this email exists, a password reset link has been sent.'
-        }), 200
+    user = User.query.filter_by(email=email).first()
 
-    except Exception as e:
-        return jsonify({'error': 'Password reset request failed'}), 500
+    # Always return success to prevent email enumeration
+    return jsonify({
+        'message': 'If an account with this email exists, a password reset link has been sent.'
+    }), 200
 
 @auth_bp.route('/logout', methods=['POST'])
 def logout():
-    try:
-        verify_jwt_in_request()
+    verify_jwt_in_request()
+    jwt_payload = get_jwt()
 
-        # In a production app, you might want to blacklist the token
-        # For now, we'll just return a success message
-        return jsonify({'message': 'Logged out successfully'}), 200
+    # Revoke the token until it would have expired anyway
+    ttl = int(jwt_payload['exp'] - time.time())
+    if ttl > 0:
+        redis_client.setex(revoked_token_key(jwt_payload['jti']), ttl, 1)
+
+    return jsonify({'message': 'Logged out successfully'}), 200
 
-    except Exception as e:
-        return jsonify({'error': 'Logout failed'}), 500
@@ -0,0 +1,108 @@
+import base64
+import orjson
+from datetime import datetime
+from flask import request, Response, stream_with_context
+from app import db
+
+def get_json_body(required_keys=()):
+    """Parse the request body with orjson, skipping the parse when a required key is absent.
+
+    Returns (data, missing_key). data is None when a key is missing from the
+    raw bytes or the body is not a JSON object.
+    """
+    raw = request.get_data(cache=True)
+    for key in required_keys:
+        if f'"{key}"'.encode() not in raw:
+            return None, key
+
+    try:
+        data = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        return None, None
+
+    if not isinstance(data, dict):
+        return None, None
+    return data, None
+
+def offset_paginate(query, page, per_page):
+    """Fetch one OFFSET page plus a lookahead row; returns (items, has_next) without a COUNT(*)"""
+    rows = query.offset((max(page, 1) - 1) * per_page).limit(per_page + 1).all()
+    return rows[:per_page], len(rows) > per_page
+
+def encode_cursor(created_at, row_id):
+    """Build an opaque keyset cursor from the last row's (created_at, id)"""
+    raw = f'{created_at.isoformat()}|{row_id}'.encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor; raises ValueError on a malformed cursor"""
+    created_at, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return datetime.fromisoformat(created_at), int(row_id)
+
+def apply_cursor(query, created_column, id_column, cursor):
+    """Order by (created_at, id) descending and seek past `cursor` if given; raises ValueError on a malformed cursor"""
+    if cursor:
+        created_at, row_id = decode_cursor(cursor)
+        query = query.filter(db.tuple_(created_column, id_column) < (created_at, row_id))
+    return query.order_by(None).order_by(created_column.desc(), id_column.desc())
+
+def page_cursor(items, has_next, created_column, id_column):
+    """Cursor for the page after `items`, or None on the last page.
+
+    Offset pages return it too, so a client can switch to keyset paging
+    from the first page onward.
+    """
+    if not has_next or not items:
+        return None
+    last = items[-1]
+    return encode_cursor(getattr(last, created_column.key), getattr(last, id_column.key))
+
+def keyset_paginate(query, created_column, id_column, cursor, per_page):
+    """Fetch the page after `cursor` ordered by (created_at, id) descending.
+
+    Seeks with a row comparison instead of OFFSET so deep pages cost the
+    same as the first. Returns (items, next_cursor); next_cursor is None on
+    the last page.
+    """
+    rows = apply_cursor(query, created_column, id_column, cursor).limit(per_page + 1).all()
+    has_next = len(rows) > per_page
+    rows = rows[:per_page]
+
+    return rows, page_cursor(rows, has_next, created_column, id_column)
+
+def iter_page(query, per_page, batch_size=50):
+    """Yield up to per_page rows, fetched batch_size at a time, plus a lookahead row.
+
+    Returns (rows, state); once rows is exhausted state holds 'last' (the
+    final row yielded) and 'has_next'.
+    """
+    state = {'last': None, 'has_next': False}
+
+    def rows():
+        for i, row in enumerate(query.limit(per_page + 1).yield_per(batch_size)):
+            if i == per_page:
+                state['has_next'] = True
+                break
+            state['last'] = row
+            yield row
+
+    return rows(), state
+
+def stream_json_page(key, rows, serialize, tail):
+    """Stream {key: [...], **tail()} one serialized row at a time.
+
+    tail is called after the rows are exhausted, so it can report
+    pagination state that depends on them.
+    """
+    def generate():
+        yield b'{' + orjson.dumps(key) + b':['
+        for i, row in enumerate(rows):
+            if i:
+                yield b','
+            yield orjson.dumps(serialize(row))
+        yield b']'
+        for name, value in tail().items():
+            yield b',' + orjson.dumps(name) + b':' + orjson.dumps(value)
+        yield b'}'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
@@ -1,212 +1,219 @@
 from flask import Blueprint, request, jsonify
 from flask_jwt_extended import verify_jwt_in_request, get_jwt_identity
+from sqlalchemy.orm import aliased
 from app import db
 from models import User, Message
+from routes.helpers import keyset_paginate, offset_paginate, page_cursor, get_json_body
 from datetime import datetime
 
 messages_bp = Blueprint('messages', __name__)
 
 @messages_bp.route('/conversations', methods=['GET'])
 def get_conversations():
-    try:
-        verify_jwt_in_request()
-        current_user_id = get_jwt_identity()
-
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 20, type=int)
-
-        # Get latest message for each conversation
-        subquery = db.session.query(
-            db.func.greatest(Message.sender_id, Message.recipient_id).label('user1'),
-            db.func.least(Message.sender_id, Message.recipient_id).label('user2'),
-            db.func.max(Message.id).label('latest_message_id')
-        ).filter(
-            (Message.sender_id == current_user_id) | (Message.recipient_id == current_user_id)
-        ).group_by('user1', 'user2').subquery()
-
-        conversations_query = db.session.query(Message).join(
-            subquery, Message.id == subquery.c.latest_message_id
-        ).order_by(Message.created_at.desc())
-
-        conversations = conversations_query.paginate(
-            page=page, per_page=per_page, error_out=False
-        )
-
-        result = []
-        for message in conversations.items:
-            # Determine the other user in the conversation
-            other_user_id = message.recipient_id if message.sender_id == current_user_id else message.sender_id
-            other_user = User.query.get(other_user_id)
-
-            # Count unread messages
-            unread_count = Message.query.filter_by(
-                sender_id=other_user_id,
-                recipient_id=current_user_id,
-                is_read=False
-            ).count()
-
-            result.append({
-                'conversation_id': f"{min(current_user_id, other_user_id)}_{max(current_user_id, other_user_id)}",
-                'other_user': other_user.to_dict(),
-                'last_message': message.to_dict(),
-                'unread_count': unread_count
-            })
-
-        return jsonify({
-            'conversations': result,
-            'has_next': conversations.has_next,
-            'has_prev': conversations.has_prev,
-            'page': page,
-            'pages': conversations.pages,
-            'total': conversations.total
-        }), 200
-
-    except Exception as e:
-        return jsonify({'error': 'Failed to fetch conversations', 'details': str(e)}), 500
+    verify_jwt_in_request()
+    current_user_id = get_jwt_identity()
+
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', 20, type=int)
+
+    # Get latest message for each conversation in a single DISTINCT ON pass
+    user1 = db.func.least(Message.sender_id, Message.recipient_id)
+    user2 = db.func.greatest(Message.sender_id, Message.recipient_id)
+    latest_messages = Message.query.filter(
+        (Message.sender_id == current_user_id) | (Message.recipient_id == current_user_id)
+    ).distinct(user1, user2).order_by(
+        user1, user2, Message.created_at.desc(), Message.id.desc()
+    ).subquery()
+    latest_message = aliased(Message, latest_messages)
+
+    conversations_query = db.session.query(latest_message).order_by(latest_message.created_at.desc())
+
+    conversations = conversations_query.paginate(
+        page=page, per_page=per_page, error_out=False
+    )
+
+    # Determine the other user in each conversation
+    other_user_ids = [
+        message.recipient_id if message.sender_id == current_user_id else message.sender_id
+        for message in conversations.items
+    ]
+
+    # Load the other users and their unread counts in one query each
+    other_users = {
+        user.id: user for user in User.query.filter(User.id.in_(other_user_ids)).all()
+    }
+    unread_counts = dict(db.session.query(
+        Message.sender_id, db.func.count(Message.id)
+    ).filter(
+        Message.recipient_id == current_user_id,
+        Message.is_read == False,
+        Message.sender_id.in_(other_user_ids)
+    ).group_by(Message.sender_id).all())
+
+    result = []
+    for message, other_user_id in zip(conversations.items, other_user_ids):
+        other_user = other_users[other_user_id]
+        unread_count = unread_counts.get(other_user_id, 0)
+
+        result.append({
+            'conversation_id': f"{min(current_user_id, other_user_id)}_{max(current_user_id, other_user_id)}",
+            'other_user': other_user.to_dict_cached(),
+            'last_message': message.to_dict(),
+            'unread_count': unread_count
+        })
+
+    return jsonify({
+        'conversations': result,
+        'has_next': conversations.has_next,
+        'has_prev': conversations.has_prev,
+        'page': page,
+        'pages': conversations.pages,
+        'total': conversations.total
+    }), 200
 
 @messages_bp.route('/conversation/<int:user_id>', methods=['GET'])
 def get_conversation_messages(user_id):
-    try:
-        verify_jwt_in_request()
-        current_user_id = get_jwt_identity()
-
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 50, type=int)
-
-        # Check if the other user exists
-        other_user = User.query.filter_by(id=user_id, is_active=True).first()
-        if not other_user:
-            return jsonify({'error': 'User not found'}), 404
-
-        # Get messages between the two users
-        messages_query = Message.query.filter(
-            ((Message.sender_id == current_user_id) & (Message.recipient_id == user_id)) |
-            ((Message.sender_id == user_id) & (Message.recipient_id == current_user_id))
-        ).order_by(Message.created_at.desc())
-
-        messages = messages_query.paginate(
-            page=page, per_page=per_page, error_out=False
-        )
-
-        # Mark messages as read
-        Message.query.filter_by(
+    verify_jwt_in_request()
+    current_user_id = get_jwt_identity()
+
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', 50, type=int)
+    cursor = request.args.get('cursor')
+
+    # Check if the other user exists
+    other_user = User.query.filter_by(id=user_id, is_active=True).first()
+    if not other_user:
+        return jsonify({'error': 'User not found'}), 404
+
+    # Get messages between the two users
+    messages_query = Message.query.filter(
+        ((Message.sender_id == current_user_id) & (Message.recipient_id == user_id)) |
+        ((Message.sender_id == user_id) & (Message.recipient_id == current_user_id))
+    ).order_by(Message.created_at.desc(), Message.id.desc())
+
+    if cursor is not None:
+        try:
+            messages, next_cursor = keyset_paginate(messages_query, Message.created_at, Message.id, cursor, per_page)
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+        has_next = next_cursor is not None
+    else:
+        messages, has_next = offset_paginate(messages_query, page, per_page)
+        next_cursor = page_cursor(messages, has_next, Message.created_at, Message.id)
+
+    # Mark messages as read whenever the latest page is opened, by page number or
+    # by an empty cursor; only commit if anything changed
+    if not cursor and (cursor is not None or page == 1):
+        updated = Message.query.filter_by(
             sender_id=user_id,
             recipient_id=current_user_id,
             is_read=False
-        ).update({'is_read': True})
-        db.session.commit()
+        ).update({'is_read': True}, synchronize_session=False)
+        if updated:
+            db.session.commit()
 
-        # Reverse the messages list to show chronological order
-        messages_list = [message.to_dict() for message in reversed(messages.items)]
+    # Reverse the messages list to show chronological order
+    messages_list = [message.to_dict() for message in reversed(messages)]
 
+    if cursor is not None:
         return jsonify({
             'messages': messages_list,
-            'other_user': other_user.to_dict(),
-            'has_next': messages.has_next,
-            'has_prev': messages.has_prev,
-            'page': page,
-            'pages': messages.pages,
-            'total': messages.total
+            'other_user': other_user.to_dict_cached(),
+            'has_next': has_next,
+            'next_cursor': next_cursor
         }), 200
 
-    except Exception as e:
-        return jsonify({'error': 'Failed to fetch messages', 'details': str(e)}), 500
+    return jsonify({
+        'messages': messages_list,
+        'other_user': other_user.to_dict_cached(),
+        'has_next': has_next,
+        'next_cursor': next_cursor,
+        'has_prev': page > 1,
+        'page': page
+    }), 200
 
 @messages_bp.route('/send', methods=['POST'])
 def send_message():
-    try:
-        verify_jwt_in_request()
-        current_user_id = get_jwt_identity()
-
-        data = request.get_json()
-        recipient_id = data.get('recipient_id')
-        content = data.get('content', '').strip()
-        message_type = data.get('message_type', 'text')
-
-        if not recipient_id or not content:
-            return jsonify({'error': 'Recipient ID and content are required'}), 400
-
-        if current_user_id == recipient_id:
-            return jsonify({'error': 'Cannot send message to yourself'}), 400
-
-        # Check if recipient exists
-        recipient = User.query.filter_by(id=recipient_id, is_active=True).first()
-        if not recipient:
-            return jsonify({'error': 'Recipient not found'}), 404
-
-        # Create message
-        new_message = Message(
-            sender_id=current_user_id,
-            recipient_id=recipient_id,
-            content=content[:1000],  # Limit message length
-            message_type=message_type
-        )
-
-        db.session.add(new_message)
-        db.session.commit()
-
-        return jsonify({
-            'message': 'Message sent successfully',
-            'message_data': new_message.to_dict()
-        }), 201
-
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'error': 'Failed to send message', 'details': str(e)}), 500
+    verify_jwt_in_request()
+    current_user_id = get_jwt_identity()
+
+    data, missing = get_json_body(('recipient_id', 'content'))
+    if missing:
+        return jsonify({'error': 'Recipient ID and content are required'}), 400
+    if data is None:
+        return jsonify({'error': 'Invalid JSON body'}), 400
+
+    recipient_id = data.get('recipient_id')
+    content = data.get('content', '').strip()
+    message_type = data.get('message_type', 'text')
+
+    if not recipient_id or not content:
+        return jsonify({'error': 'Recipient ID and content are required'}), 400
+
+    if current_user_id == recipient_id:
+        return jsonify({'error': 'Cannot send message to yourself'}), 400
+
+    # Check if recipient exists
+    recipient = User.query.filter_by(id=recipient_id, is_active=True).first()
+    if not recipient:
+        return jsonify({'error': 'Recipient not found'}), 404
+
+    # Create message
+    new_message = Message(
+        sender_id=current_user_id,
+        recipient_id=recipient_id,
+        content=content[:1000],  # Limit message length
+        message_type=message_type
+    )
+
+    db.session.add(new_message)
+    db.session.commit()
+
+    return jsonify({
+        'message': 'Message sent successfully',
+        'message_data': new_message.to_dict()
+    }), 201
 
 @messages_bp.route('/<int:message_id>/read', methods=['PUT'])
 def mark_message_read(message_id):
-    try:
-        verify_jwt_in_request()
-        current_user_id = get_jwt_identity()
-
-        message = Message.query.filter_by(
-            id=message_id, recipient_id=current_user_id
-        ).first()
+    verify_jwt_in_request()
+    current_user_id = get_jwt_identity()
 
-        if not message:
-            return jsonify({'error': 'Message not found'}), 404
+    message = Message.query.filter_by(
+        id=message_id, recipient_id=current_user_id
+    ).first()
 
-        message.is_read = True
-        db.session.commit()
+    if not message:
+        return jsonify({'error': 'Message not found'}), 404
 
-        return jsonify({'message': 'Message marked as read'}), 200
+    message.is_read = True
+    db.session.commit()
 
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'error': 'Failed to mark message as read', 'details': str(e)}), 500
+    return jsonify({'message': 'Message marked as read'}), 200
 
 @messages_bp.route('/unread-count', methods=['GET'])
 def get_unread_count():
-    try:
-        verify_jwt_in_request()
-        current_user_id = get_jwt_identity()
-
-        unread_count = Message.query.filter_by(
-            recipient_id=current_user_id, is_read=False
-        ).count()
+    verify_jwt_in_request()
+    current_user_id = get_jwt_identity()
 
-        return jsonify({'unread_count': unread_count}), 200
+    unread_count = Message.query.filter_by(
+        recipient_id=current_user_id, is_read=False
+    ).count()
 
-    except Exception as e:
-        return jsonify({'error': 'Failed to fetch unread count', 'details': str(e)}), 500
+    return jsonify({'unread_count': unread_count}), 200
 
 @messages_bp.route('/conversation/<int:user_id>/delete', methods=['DELETE'])
 def delete_conversation(user_id):
-    try:
-        verify_jwt_in_request()
-        current_user_id = get_jwt_identity()
+    verify_jwt_in_request()
+    current_user_id = get_jwt_identity()
 
-        # Delete all messages between the two users
-        Message.query.filter(
-            ((Message.sender_id == current_user_id) & (Message.recipient_id == user_id)) |
-            ((Message.sender_id == user_id) & (Message.recipient_id == current_user_id))
-        ).delete()
+    # Delete all messages between the two users
+    Message.query.filter(
+        ((Message.sender_id == current_user_id) & (Message.recipient_id == user_id)) |
+        ((Message.sender_id == user_id) & (Message.recipient_id == current_user_id))
+    ).delete()
 
-        db.session.commit()
+    db.session.commit()
 
-        return jsonify({'message': 'Conversation deleted successfully'}), 200
+    return jsonify({'message': 'Conversation deleted successfully'}), 200
 
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'error': 'Failed to delete conversation', 'details': str(e)}), 500
@@ -1,9 +1,13 @@
 from flask import Blueprint, request, jsonify
 from flask_jwt_extended import verify_jwt_in_request, get_jwt_identity
 from werkzeug.utils import secure_filename
-from app import db
-from models import User, Post, Like, Comment, Follow
+from sqlalchemy.orm import selectinload
+from sqlalchemy.dialects.postgresql import insert
+from app import db, get_current_user
+from models import Post, Like, Comment, Follow, Notification, invalidate_user_dicts, serialize_posts
+from routes.helpers import keyset_paginate, offset_paginate, page_cursor
 from ml_algorithms import RecommendationEngine, ContentModerator, ImageProcessor
+from tasks import enqueue, moderate_post, moderate_comment
 import os
 from datetime import datetime
 import uuid
@@ -14,328 +18,330 @@ image_processor = ImageProcessor()
 
 @posts_bp.route('/', methods=['GET'])
 def get_posts():
-    try:
-        verify_jwt_in_request()
-        current_user_id = get_jwt_identity()
+    verify_jwt_in_request()
+    current_user_id = get_jwt_identity()
 
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 20, type=int)
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', 20, type=int)
+    cursor = request.args.get('cursor')
 
-        # Get posts from followed users and own posts
-        following_ids = db.session.query(Follow.followed_id).filter_by(follower_id=current_user_id).all()
-        following_ids = [id[0] for id in following_ids] + [current_user_id]
+    # Get posts from followed users and own posts
+    following_ids = db.select(Follow.followed_id).where(Follow.follower_id == current_user_id)
 
-        posts_query = Post.query.filter(
-            Post.user_id.in_(following_ids),
-            Post.is_active == True
-        ).order_by(Post.created_at.desc())
+    posts_query = Post.query.options(selectinload(Post.author)).filter(
+        db.or_(Post.user_id.in_(following_ids), Post.user_id == current_user_id),
+        Post.is_active == True
+    ).order_by(Post.created_at.desc(), Post.id.desc())
 
-        posts = posts_query.paginate(
-            page=page, per_page=per_page, error_out=False
-        )
+    current_user = get_current_user()
 
-        current_user = User.query.get(current_user_id)
+    if cursor is not None:
+        try:
+            items, next_cursor = keyset_paginate(posts_query, Post.created_at, Post.id, cursor, per_page)
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
 
         return jsonify({
-            'posts': [post.to_dict(current_user) for post in posts.items],
-            'has_next': posts.has_next,
-            'has_prev': posts.has_prev,
-            'page': page,
-            'pages': posts.pages,
-            'total': posts.total
+            'posts': serialize_posts(items, current_user),
+            'has_next': next_cursor is not None,
+            'next_cursor': next_cursor
         }), 200
 
-    except Exception as e:
-        return jsonify({'error': 'Failed to fetch posts', 'details': str(e)}), 500
+    posts, has_next = offset_paginate(posts_query, page, per_page)
+
+    return jsonify({
+        'posts': serialize_posts(posts, current_user),
+        'has_next': has_next,
+        'next_cursor': page_cursor(posts, has_next, Post.created_at, Post.id),
+        'has_prev': page > 1,
+        'page': page
+    }), 200
 
 @posts_bp.route('/', methods=['POST'])
 def create_post():
-    try:
-        verify_jwt_in_request()
-        current_user_id = get_jwt_identity()
-
-        data = request.get_json()
-
-        if not data.get('image_url'):
-            return jsonify({'error': 'Image URL is required'}), 400
-
-        caption = data.get('caption', '')
-        location = data.get('location', '')
-        image_url = data['image_url']
-
-        # Moderate content
-        if caption:
-            moderation_result = content_moderator.moderate_text(caption)
-            if not moderation_result['is_appropriate']:
-                return jsonify({
-                    'error': 'Content violates community guidelines',
-                    'issues': moderation_result['issues']
-                }), 400
-
-        # Analyze image
-        image_analysis = image_processor.analyze_image(image_url)
-        if not image_analysis.get('is_valid', True):
-            return jsonify({'error': 'Invalid image'}), 400
-
-        # Create post
-        new_post = Post(
-            user_id=current_user_id,
-            caption=caption[:2200],  # Limit caption length
-            image_url=image_url,
-            location=location
-        )
+    verify_jwt_in_request()
+    current_user_id = get_jwt_identity()
 
-        db.session.add(new_post)
-        db.session.commit()
+    data = request.get_json()
 
-        # Get suggested hashtags
-        suggested_hashtags = image_processor.suggest_hashtags(image_url, caption)
+    if not data.get('image_url'):
+        return jsonify({'error': 'Image URL is required'}), 400
 
-        current_user = User.query.get(current_user_id)
+    caption = data.get('caption', '')
+    location = data.get('location', '')
+    image_url = data['image_url']
 
+    # Cheap wordlist check inline; full moderation runs in the worker
+    if caption and content_moderator.has_inappropriate_keywords(caption):
         return jsonify({
-            'message': 'Post created successfully',
-            'post': new_post.to_dict(current_user),
-            'suggested_hashtags': suggested_hashtags,
-            'image_analysis': image_analysis
-        }), 201
+            'error': 'Content violates community guidelines',
+            'issues': ['inappropriate_language']
+        }), 400
 
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'error': 'Failed to create post', 'details': str(e)}), 500
+    # Analyze image; this only inspects the URL, so it stays on the request path
+    image_analysis = image_processor.analyze_image(image_url)
+    if not image_analysis.get('is_valid', True):
+        return jsonify({'error': 'Invalid image'}), 400
 
-@posts_bp.route('/<int:post_id>', methods=['GET'])
-def get_post(post_id):
-    try:
-        verify_jwt_in_request()
-        current_user_id = get_jwt_identity()
+    # Create post
+    new_post = Post(
+        user_id=current_user_id,
+        caption=caption[:2200],  # Limit caption length
+        image_url=image_url,
+        location=location
+    )
 
-        post = Post.query.filter_by(id=post_id, is_active=True).first()
-        if not post:
-            return jsonify({'error': 'Post not found'}), 404
+    db.session.add(new_post)
+    db.session.commit()
+    invalidate_user_dicts(current_user_id)
 
-        current_user = User.query.get(current_user_id)
+    enqueue(moderate_post, new_post.id)
 
-        # Get comments
-        comments = Comment.query.filter_by(
-            post_id=post_id, is_active=True, parent_id=None
-        ).order_by(Comment.created_at.desc()).limit(20).all()
+    # Get suggested hashtags
+    suggested_hashtags = image_processor.suggest_hashtags(image_url, caption)
 
-        return jsonify({
-            'post': post.to_dict(current_user),
-            'comments': [comment.to_dict() for comment in comments]
-        }), 200
+    current_user = get_current_user()
 
-    except Exception as e:
-        return jsonify({'error': 'Failed to fetch post', 'details': str(e)}), 500
+    return jsonify({
+        'message': 'Post created successfully',
+        'post': new_post.to_dict(current_user),
+        'suggested_hashtags': suggested_hashtags,
+        'image_analysis': image_analysis
+    }), 201
 
-@posts_bp.route('/<int:post_id>/like', methods=['POST'])
-def like_post(post_id):
-    try:
-        verify_jwt_in_request()
-        current_user_id = get_jwt_identity()
+@posts_bp.route('/<int:post_id>', methods=['GET'])
+def get_post(post_id):
+    verify_jwt_in_request()
 
-        post = Post.query.filter_by(id=post_id, is_active=True).first()
-        if not post:
-            return jsonify({'error': 'Post not found'}), 404
+    post = Post.query.filter_by(id=post_id, is_active=True).first()
+    if not post:
+        return jsonify({'error': 'Post not found'}), 404
 
-        # Check if already liked
-        existing_like = Like.query.filter_by(
-            user_id=current_user_id, post_id=post_id
-        ).first()
+    current_user = get_current_user()
 
-        if existing_like:
-            # Unlike
-            db.session.delete(existing_like)
-            action = 'unliked'
-        else:
-            # Like
-            new_like = Like(user_id=current_user_id, post_id=post_id)
-            db.session.add(new_like)
-            action = 'liked'
-
-            # Create notification for post author (if not liking own post)
-            if post.user_id != current_user_id:
-                from models import Notification
-                current_user = User.query.get(current_user_id)
-                notification = Notification(
-                    user_id=post.user_id,
-                    type='like',
-                    title='New Like',
-                    message=f'{current_user.username} liked your post',
-                    action_user_id=current_user_id,
-                    related_post_id=post_id
-                )
-                db.session.add(notification)
-
-        db.session.commit()
+    # Get comments
+    comments = Comment.query.options(selectinload(Comment.author)).filter_by(
+        post_id=post_id, is_active=True, parent_id=None
+    ).order_by(Comment.created_at.desc()).limit(20).all()
 
-        return jsonify({
-            'message': f'Post {action} successfully',
-            'likes_count': post.get_likes_count(),
-            'is_liked': action == 'liked'
-        }), 200
+    return jsonify({
+        'post': post.to_dict(current_user),
+        'comments': [comment.to_dict() for comment in comments]
+    }), 200
 
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'error': f'Failed to {action if "action" in locals() else "like"} post'}), 500
+@posts_bp.route('/<int:post_id>/like', methods=['POST'])
+def like_post(post_id):
+    verify_jwt_in_request()
+    current_user_id = get_jwt_identity()
+
+    post = Post.query.filter_by(id=post_id, is_active=True).first()
+    if not post:
+        return jsonify({'error': 'Post not found'}), 404
+
+    # Like; the unique constraint turns a repeat into a no-op instead of an error
+    now = datetime.utcnow()
+    like_insert = insert(Like).values(
+        user_id=current_user_id, post_id=post_id, created_at=now
+    ).on_conflict_do_nothing(constraint='unique_user_post_like').returning(Like.id)
+
+    if post.user_id != current_user_id:
+        # Notify the post author in the same statement; the SELECT only yields a row if the like was inserted
+        new_like = like_insert.cte('new_like')
+        notification_insert = db.insert(Notification).from_select(
+            ['user_id', 'type', 'title', 'message', 'action_user_id', 'related_post_id', 'is_read', 'created_at'],
+            db.select(
+                db.literal(post.user_id), db.literal('like'), db.literal('New Like'),
+                db.literal(f'{get_current_user().username} liked your post'),
+                db.literal(current_user_id), db.literal(post_id), db.literal(False), db.literal(now)
+            ).select_from(new_like)
+        ).cte('new_notification')
+        like_id = db.session.execute(db.select(new_like.c.id).add_cte(notification_insert)).scalar()
+    else:
+        like_id = db.session.execute(like_insert).scalar()
+
+    if like_id is None:
+        # Already liked, so toggle to unlike
+        db.session.execute(
+            db.delete(Like).where(Like.user_id == current_user_id, Like.post_id == post_id)
+        )
+        action = 'unliked'
+    else:
+        action = 'liked'
+
+    db.session.commit()
+
+    return jsonify({
+        'message': f'Post {action} successfully',
+        'likes_count': post.get_likes_count(),
+        'is_liked': action == 'liked'
+    }), 200
 
 @posts_bp.route('/<int:post_id>/comments', methods=['POST'])
 def add_comment(post_id):
-    try:
-        verify_jwt_in_request()
-        current_user_id = get_jwt_identity()
-
-        data = request.get_json()
-        text = data.get('text', '').strip()
-        parent_id = data.get('parent_id')
-
-        if not text:
-            return jsonify({'error': 'Comment text is required'}), 400
-
-        post = Post.query.filter_by(id=post_id, is_active=True).first()
-        if not post:
-            return jsonify({'error': 'Post not found'}), 404
-
-        # Moderate comment
-        moderation_result = content_moderator.moderate_text(text)
-        if not moderation_result['is_appropriate']:
-            return jsonify({
-                'error': 'Comment violates community guidelines',
-                'issues': moderation_result['issues']
-            }), 400
-
-        # Check if parent comment exists (for replies)
-        if parent_id:
-            parent_comment = Comment.query.filter_by(
-                id=parent_id, post_id=post_id, is_active=True
-            ).first()
-            if not parent_comment:
-                return jsonify({'error': 'Parent comment not found'}), 404
-
-        # Create comment
-        new_comment = Comment(
-            user_id=current_user_id,
-            post_id=post_id,
-            text=text[:500],  # Limit comment length
-            parent_id=parent_id
-        )
+    verify_jwt_in_request()
+    current_user_id = get_jwt_identity()
 
-        db.session.add(new_comment)
+    data = request.get_json()
+    text = data.get('text', '').strip()
+    parent_id = data.get('parent_id')
 
-        # Create notification for post author (if not commenting on own post)
-        if post.user_id != current_user_id:
-            from models import Notification
-            current_user = User.query.get(current_user_id)
-            notification = Notification(
-                user_id=post.user_id,
-                type='comment',
-                title='New Comment',
-                message=f'{current_user.username} commented on your post',
-                action_user_id=current_user_id,
-                related_post_id=post_id
-            )
-            db.session.add(notification)
+    if not text:
+        return jsonify({'error': 'Comment text is required'}), 400
 
-        db.session.commit()
+    post = Post.query.filter_by(id=post_id, is_active=True).first()
+    if not post:
+        return jsonify({'error': 'Post not found'}), 404
 
+    # Cheap wordlist check inline; full moderation runs in the worker
+    if content_moderator.has_inappropriate_keywords(text):
         return jsonify({
-            'message': 'Comment added successfully',
-            'comment': new_comment.to_dict(),
-            'comments_count': post.get_comments_count()
-        }), 201
-
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'error': 'Failed to add comment', 'details': str(e)}), 500
+            'error': 'Comment violates community guidelines',
+            'issues': ['inappropriate_language']
+        }), 400
+
+    # Check if parent comment exists (for replies)
+    if parent_id:
+        parent_comment = Comment.query.filter_by(
+            id=parent_id, post_id=post_id, is_active=True
+        ).first()
+        if not parent_comment:
+            return jsonify({'error': 'Parent comment not found'}), 404
+
+    # Insert the comment, bump the counters and notify the post author in one statement.
+    # Core inserts skip the Comment mapper listeners, so the counter updates run here
+    now = datetime.utcnow()
+    new_comment = db.insert(Comment).values(
+        user_id=current_user_id, post_id=post_id, text=text[:500],  # Limit comment length
+        parent_id=parent_id, is_active=True, created_at=now
+    ).returning(Comment.id).cte('new_comment')
+    comments_count = db.update(Post).where(Post.id == post_id).values(
+        # Carry updated_at over so the column's onupdate doesn't mark the post as edited
+        comments_count=Post.comments_count + 1, updated_at=Post.updated_at
+    ).returning(Post.comments_count).cte('post_comments_count')
+    statement = db.select(new_comment.c.id, comments_count.c.comments_count)
+
+    if parent_id:
+        statement = statement.add_cte(db.update(Comment).where(Comment.id == parent_id).values(
+            replies_count=Comment.replies_count + 1
+        ).cte('parent_replies_count'))
+
+    # Notify the post author (if not commenting on own post)
+    if post.user_id != current_user_id:
+        statement = statement.add_cte(db.insert(Notification).from_select(
+            ['user_id', 'type', 'title', 'message', 'action_user_id', 'related_post_id', 'is_read', 'created_at'],
+            db.select(
+                db.literal(post.user_id), db.literal('comment'), db.literal('New Comment'),
+                db.literal(f'{get_current_user().username} commented on your post'),
+                db.literal(current_user_id), db.literal(post_id), db.literal(False), db.literal(now)
+            ).select_from(new_comment)
+        ).cte('new_notification'))
+
+    comment_id, new_comments_count = db.session.execute(statement).one()
+    db.session.commit()
+
+    enqueue(moderate_comment, comment_id)
+
+    return jsonify({
+        'message': 'Comment added successfully',
+        'comment': db.session.get(Comment, comment_id).to_dict(),
+        'comments_count': new_comments_count
+    }), 201
 
 @posts_bp.route('/<int:post_id>/comments', methods=['GET'])
 def get_comments(post_id):
-    try:
-        verify_jwt_in_request()
+    verify_jwt_in_request()
 
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 20, type=int)
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', 20, type=int)
+    cursor = request.args.get('cursor')
 
-        post = Post.query.filter_by(id=post_id, is_active=True).first()
-        if not post:
-            return jsonify({'error': 'Post not found'}), 404
+    post = Post.query.filter_by(id=post_id, is_active=True).first()
+    if not post:
+        return jsonify({'error': 'Post not found'}), 404
 
-        comments_query = Comment.query.filter_by(
-            post_id=post_id, is_active=True, parent_id=None
-        ).order_by(Comment.created_at.desc())
+    comments_query = Comment.query.options(selectinload(Comment.author)).filter_by(
+        post_id=post_id, is_active=True, parent_id=None
+    ).order_by(Comment.created_at.desc(), Comment.id.desc())
 
-        comments = comments_query.paginate(
-            page=page, per_page=per_page, error_out=False
-        )
+    if cursor is not None:
+        try:
+            items, next_cursor = keyset_paginate(comments_query, Comment.created_at, Comment.id, cursor, per_page)
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
 
         return jsonify({
-            'comments': [comment.to_dict() for comment in comments.items],
-            'has_next': comments.has_next,
-            'has_prev': comments.has_prev,
-            'page': page,
-            'pages': comments.pages,
-            'total': comments.total
+            'comments': [comment.to_dict() for comment in items],
+            'has_next': next_cursor is not None,
+            'next_cursor': next_cursor
         }), 200
 
-    except Exception as e:
-        return jsonify({'error': 'Failed to fetch comments', 'details': str(e)}), 500
+    comments, has_next = offset_paginate(comments_query, page, per_page)
+
+    return jsonify({
+        'comments': [comment.to_dict() for comment in comments],
+        'has_next': has_next,
+        'next_cursor': page_cursor(comments, has_next, Comment.created_at, Comment.id),
+        'has_prev': page > 1,
+        'page': page
+    }), 200
 
 @posts_bp.route('/<int:post_id>', methods=['DELETE'])
 def delete_post(post_id):
-    try:
-        verify_jwt_in_request()
-        current_user_id = get_jwt_identity()
-
-        post = Post.query.filter_by(
-            id=post_id, user_id=current_user_id, is_active=True
-        ).first()
+    verify_jwt_in_request()
+    current_user_id = get_jwt_identity()
 
-        if not post:
-            return jsonify({'error': 'Post not found or unauthorized'}), 404
+    post = Post.query.filter_by(
+        id=post_id, user_id=current_user_id, is_active=True
+    ).first()
 
-        # Soft delete
-        post.is_active = False
-        db.session.commit()
+    if not post:
+        return jsonify({'error': 'Post not found or unauthorized'}), 404
 
-        return jsonify({'message': 'Post deleted successfully'}), 200
+    # Soft delete
+    post.is_active = False
+    db.session.commit()
 
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'error': 'Failed to delete post', 'details': str(e)}), 500
+    return jsonify({'message': 'Post deleted successfully'}), 200
 
 @posts_bp.route('/explore', methods=['GET'])
 def explore_posts():
-    try:
-        verify_jwt_in_request()
-        current_user_id = get_jwt_identity()
+    verify_jwt_in_request()
+    current_user_id = get_jwt_identity()
 
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 20, type=int)
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', 20, type=int)
+    cursor = request.args.get('cursor')
 
-        # Get posts from users not followed by current user
-        following_ids = db.session.query(Follow.followed_id).filter_by(follower_id=current_user_id).all()
-        following_ids = [id[0] for id in following_ids] + [current_user_id]
+    # Get posts from users not followed by current user
+    following_ids = db.select(Follow.followed_id).where(Follow.follower_id == current_user_id)
 
-        posts_query = Post.query.filter(
-            ~Post.user_id.in_(following_ids),
-            Post.is_active == True
-        ).order_by(Post.created_at.desc())
+    posts_query = Post.query.options(selectinload(Post.author)).filter(
+        ~Post.user_id.in_(following_ids),
+        Post.user_id != current_user_id,
+        Post.is_active == True
+    ).order_by(Post.created_at.desc(), Post.id.desc())
 
-        posts = posts_query.paginate(
-            page=page, per_page=per_page, error_out=False
-        )
+    current_user = get_current_user()
 
-        current_user = User.query.get(current_user_id)
+    if cursor is not None:
+        try:
+            items, next_cursor = keyset_paginate(posts_query, Post.created_at, Post.id, cursor, per_page)
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
 
         return jsonify({
-            'posts': [post.to_dict(current_user) for post in posts.items],
-            'has_next': posts.has_next,
-            'has_prev': posts.has_prev,
-            'page': page,
-            'pages': posts.pages,
-            'total': posts.total
+            'posts': serialize_posts(items, current_user),
+            'has_next': next_cursor is not None,
+            'next_cursor': next_cursor
         }), 200
 
-    except Exception as e:
-        return jsonify({'error': 'Failed to fetch explore posts', 'details': str(e)}), 500
+    posts, has_next = offset_paginate(posts_query, page, per_page)
+
+    return jsonify({
+        'posts': serialize_posts(posts, current_user),
+        'has_next': has_next,
+        'next_cursor': page_cursor(posts, has_next, Post.created_at, Post.id),
+        'has_prev': page > 1,
+        'page': page
+    }), 200
+
@@ -6,21 +6,21 @@ Run this script to start the Instagram clone backend server.
 
 import os
 import sys
-from dotenv import load_dotenv
+from collections import Counter
 
-# Load environment variables from .env file
-load_dotenv()
+# Environment variables from .env are loaded by config.py
 
 # Add the current directory to Python path
 current_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, current_dir)
 
-from app import app, socketio, db
-from models import User, Post, Story, Like, Comment, Follow, Message, Notification
+from app import app, socketio, db, password_hasher, init_database
+from models import User, Post, Story, Like, Comment, Follow, Message, Notification, refresh_post_engagement_view
 
 def create_sample_data():
     """Create sample data for development/testing"""
-    if User.query.count() == 0:
+    # EXISTS stops at the first row instead of counting the whole table
+    if not db.session.query(User.query.exists()).scalar():
         print("Creating sample data...")
 
         # Create sample users
@@ -60,109 +60,113 @@ def create_sample_data():
             }
         ]
 
-        created_users = []
-        for user_data in users:
-            user = User(
-                username=user_data['username'],
-                email=user_data['email'],
-                full_name=user_data['full_name'],
-                bio=user_data.get('bio', ''),
-                profile_picture=user_data.get('profile_picture'),
-                is_verified=user_data.get('is_verified', False)
-            )
-            user.set_password(user_data['password'])
-            db.session.add(user)
-            created_users.append(user)
+        # Sample interactions by list index: follows are (follower, followed) users,
+        # comments are (user, post, text) with post indexing sample_posts below
+        sample_follows = [
+            (1, 2),  # John follows Sarah
+            (2, 1),  # Sarah follows John
+            (3, 1)   # Mike follows John
+        ]
+        sample_comments = [
+            (2, 0, "Stunning shot! 😍"),
+            (3, 0, "Love the colors!"),
+            (1, 1, "Amazing work! Keep it up 👏")
+        ]
 
-        db.session.commit()
-        print(f"Created {len(created_users)} sample users")
+        # One multi-row INSERT per table; ORM bulk inserts skip the counter event
+        # listeners, so followers_count / comments_count are derived from the rows
+        followers_counts = Counter(followed for _, followed in sample_follows)
+        comments_counts = Counter(post for _, post, _ in sample_comments)
+        # The sample accounts share a password, so hash each distinct one only once
+        password_hashes = {
+            password: password_hasher.hash(password) for password in {user_data['password'] for user_data in users}
+        }
+        user_rows = []
+        for i, user_data in enumerate(users):
+            user_rows.append({
+                'username': user_data['username'],
+                'email': user_data['email'],
+                'full_name': user_data['full_name'],
+                'password_hash': password_hashes[user_data['password']],
+                'bio': user_data.get('bio', ''),
+                'profile_picture': user_data.get('profile_picture'),
+                'is_verified': user_data.get('is_verified', False),
+                'followers_count': followers_counts[i]
+            })
+
+        user_ids = db.session.scalars(
+            db.insert(User).returning(User.id, sort_by_parameter_order=True), user_rows
+        ).all()
+        print(f"Created {len(user_ids)} sample users")
 
         # Create sample posts
         sample_posts = [
             {
-                'user': created_users[1],  # johndoe
+                'user_id': user_ids[1],  # johndoe
                 'image_url': 'https://images.unsplash.com/photo-1506905925346-21bda4d32df4?w=600&h=600&fit=crop',
                 'caption': 'Beautiful sunset at the beach! 🌅 #sunset #beach #photography',
                 'location': 'Malibu Beach'
             },
             {
-                'user': created_users[2],  # sarahwilson
+                'user_id': user_ids[2],  # sarahwilson
                 'image_url': 'https://images.unsplash.com/photo-1513475382585-d06e58bcb0e0?w=600&h=600&fit=crop',
                 'caption': 'New artwork in progress! 🎨 What do you think? #art #painting #creative',
                 'location': 'Art Studio'
             },
             {
-                'user': created_users[3],  # mikejohnson
+                'user_id': user_ids[3],  # mikejohnson
                 'image_url': 'https://images.unsplash.com/photo-1571019613454-1cb2f99b2d8b?w=600&h=600&fit=crop',
                 'caption': 'Morning workout done! 💪 Remember, consistency is key! #fitness #workout #motivation',
                 'location': 'Gold\'s Gym'
             }
         ]
 
-        for post_data in sample_posts:
-            post = Post(
-                user_id=post_data['user'].id,
-                image_url=post_data['image_url'],
-                caption=post_data['caption'],
-                location=post_data['location']
-            )
-            db.session.add(post)
+        for i, post_data in enumerate(sample_posts):
+            post_data['comments_count'] = comments_counts[i]
 
-        db.session.commit()
+        post_ids = db.session.scalars(
+            db.insert(Post).returning(Post.id, sort_by_parameter_order=True), sample_posts
+        ).all()
         print(f"Created {len(sample_posts)} sample posts")
 
         # Create some sample interactions
-        posts = Post.query.all()
-        if posts:
-            # Add some likes
-            like1 = Like(user_id=created_users[1].id, post_id=posts[1].id)  # John likes Sarah's post
-            like2 = Like(user_id=created_users[2].id, post_id=posts[0].id)  # Sarah likes John's post  
-            like3 = Like(user_id=created_users[3].id, post_id=posts[0].id)  # Mike likes John's post
-
-            db.session.add_all([like1, like2, like3])
-
-            # Add some comments
-            comment1 = Comment(
-                user_id=created_users[2].id, 
-                post_id=posts[0].id, 
-                text="Stunning shot! 😍"
-            )
-            comment2 = Comment(
-                user_id=created_users[3].id, 
-                post_id=posts[0].id, 
-                text="Love the colors!"
-            )
-            comment3 = Comment(
-                user_id=created_users[1].id, 
-                post_id=posts[1].id, 
-                text="Amazing work! Keep it up 👏"
-            )
-
-            db.session.add_all([comment1, comment2, comment3])
-
-            # Add some follows
-            follow1 = Follow(follower_id=created_users[1].id, followed_id=created_users[2].id)  # John follows Sarah
-            follow2 = Follow(follower_id=created_users[2].id, followed_id=created_users[1].id)  # Sarah follows John
-            follow3 = Follow(follower_id=created_users[3].id, followed_id=created_users[1].id)  # Mike follows John
-
-            db.session.add_all([follow1, follow2, follow3])
-
-            db.session.commit()
-            print("Created sample interactions (likes, comments, follows)")
+        db.session.execute(db.insert(Like), [
+            {'user_id': user_ids[1], 'post_id': post_ids[1]},  # John likes Sarah's post
+            {'user_id': user_ids[2], 'post_id': post_ids[0]},  # Sarah likes John's post
+            {'user_id': user_ids[3], 'post_id': post_ids[0]}   # Mike likes John's post
+        ])
+
+        db.session.execute(db.insert(Comment), [
+            {'user_id': user_ids[user], 'post_id': post_ids[post], 'text': text}
+            for user, post, text in sample_comments
+        ])
+
+        db.session.execute(db.insert(Follow), [
+            {'follower_id': user_ids[follower], 'followed_id': user_ids[followed]}
+            for follower, followed in sample_follows
+        ])
+
+        print("Created sample interactions (likes, comments, follows)")
+
+        # Everything above lands in a single transaction, with the sample likes counted in the view
+        refresh_post_engagement_view(db.session.connection())
+        db.session.commit()
 
         print("Sample data creation completed!")
 
 if __name__ == '__main__':
-    # Create database tables
-    with app.app_context():
-        db.create_all()
-        create_sample_data()
-
     # Configuration
     host = os.environ.get('HOST', '0.0.0.0')
     port = int(os.environ.get('PORT', 5000))
     debug = os.environ.get('DEBUG', 'True').lower() == 'true'
 
+    # Create database tables; in debug mode this script also runs in the reloader's
+    # parent process, so only the serving child (WERKZEUG_RUN_MAIN) does the setup
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        with app.app_context():
+            init_database()
+            create_sample_data()
+
     print(f"""
     🚀 Instagram Clone Backend Server Starting...
 
@@ -0,0 +1,151 @@
+from celery import Celery
+from kombu.exceptions import OperationalError
+from config import Config
+from ml_algorithms import ContentModerator, ImageProcessor, RecommendationEngine, Interactions
+from datetime import datetime, timedelta
+import logging
+
+celery = Celery(
+    'instagram_clone',
+    broker=Config.CELERY_BROKER_URL,
+    backend=Config.CELERY_RESULT_BACKEND
+)
+celery.conf.beat_schedule = {
+    'refresh-user-clusters': {
+        'task': 'tasks.refresh_user_clusters',
+        'schedule': Config.USER_CLUSTER_REFRESH_SECONDS
+    },
+    'refresh-post-engagement': {
+        'task': 'tasks.refresh_post_engagement',
+        'schedule': Config.POST_ENGAGEMENT_REFRESH_SECONDS
+    },
+    'moderate-pending-posts': {
+        'task': 'tasks.moderate_pending_posts',
+        'schedule': Config.PENDING_MODERATION_SWEEP_SECONDS
+    }
+}
+logger = logging.getLogger(__name__)
+
+content_moderator = ContentModerator()
+image_processor = ImageProcessor()
+recommendation_engine = RecommendationEngine()
+
+# app/models are imported inside the tasks: routes import this module while app.py is still loading
+
+def enqueue(task, *args):
+    """Queue a task after the request's commit; a broker outage is logged instead of failing the request"""
+    try:
+        task.delay(*args)
+    except OperationalError as e:
+        logger.error(f'Could not queue {task.name}{args}: {str(e)}')
+
+@celery.task
+def moderate_post(post_id):
+    """Run the full text and image moderation for a post and hide it if it fails"""
+    from app import app, db
+    from models import Post
+
+    with app.app_context():
+        post = Post.query.get(post_id)
+        if not post:
+            return
+
+        moderation_result = content_moderator.moderate_text(post.caption or '')
+        image_analysis = image_processor.analyze_image(post.image_url)
+
+        if not moderation_result['is_appropriate'] or not image_analysis.get('is_valid', True):
+            post.is_active = False
+            post.moderation_status = 'rejected'
+            logger.info(f'Post {post_id} rejected by moderation: {moderation_result["issues"]}')
+        else:
+            post.moderation_status = 'approved'
+
+        db.session.commit()
+
+@celery.task
+def moderate_comment(comment_id):
+    """Run the full text moderation for a comment and hide it if it fails"""
+    from app import app, db
+    from models import Comment
+
+    with app.app_context():
+        comment = Comment.query.get(comment_id)
+        if not comment:
+            return
+
+        moderation_result = content_moderator.moderate_text(comment.text)
+        if not moderation_result['is_appropriate']:
+            comment.is_active = False
+            db.session.commit()
+            logger.info(f'Comment {comment_id} rejected by moderation: {moderation_result["issues"]}')
+
+@celery.task
+def refresh_user_clusters():
+    """Re-fit the user clusters and store each active user's cluster_id"""
+    from app import app, db
+    from models import User, Post, Like, Follow
+
+    with app.app_context():
+        # User features, with the remaining counts in one grouped query each
+        users = db.session.query(User.id, User.bio, User.followers_count).filter(User.is_active == True).all()
+        following_counts = dict(db.session.query(
+            Follow.follower_id, db.func.count()
+        ).group_by(Follow.follower_id).all())
+        posts_counts = dict(db.session.query(
+            Post.user_id, db.func.count(Post.id)
+        ).group_by(Post.user_id).all())
+
+        users_data = [{
+            'id': user_id,
+            'bio': bio or '',
+            'followers_count': followers_count,
+            'following_count': following_counts.get(user_id, 0),
+            'posts_count': posts_counts.get(user_id, 0)
+        } for user_id, bio, followers_count in users]
+
+        # Recent likes as the interaction signal
+        cutoff = datetime.utcnow() - timedelta(days=app.config['RECOMMENDATION_INTERACTION_WINDOW_DAYS'])
+        interactions = Interactions.from_rows(
+            (db.session.query(Like.user_id, Like.post_id).filter(Like.created_at > cutoff).yield_per(10000), 1)
+        )
+
+        user_clusters = recommendation_engine.user_clustering(users_data, interactions)
+        if not user_clusters:
+            return
+
+        # Bulk UPDATE by primary key
+        db.session.execute(
+            db.update(User),
+            [{'id': user_id, 'cluster_id': int(cluster)} for user_id, cluster in user_clusters.items()]
+        )
+        db.session.commit()
+        logger.info(f'Assigned {len(user_clusters)} users to clusters')
+
+@celery.task
+def refresh_post_engagement():
+    """Refresh the mv_post_engagement like counts without blocking readers"""
+    from app import app, db
+    from models import refresh_post_engagement_view
+
+    with app.app_context():
+        refresh_post_engagement_view(db.session.connection())
+        db.session.commit()
+
+@celery.task
+def moderate_pending_posts():
+    """Re-queue posts still pending moderation, e.g. because the broker was down when they were created"""
+    from app import app, db
+    from models import Post
+
+    with app.app_context():
+        cutoff = datetime.utcnow() - timedelta(seconds=Config.PENDING_MODERATION_SWEEP_SECONDS)
+        post_ids = db.session.scalars(
+            db.select(Post.id).where(
+                Post.moderation_status == 'pending', Post.is_active == True, Post.created_at < cutoff
+            ).limit(500)
+        ).all()
+
+    for post_id in post_ids:
+        moderate_post.delay(post_id)
+    if post_ids:
+        logger.info(f'Re-queued {len(post_ids)} posts pending moderation')